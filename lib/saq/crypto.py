@@ -3,7 +3,6 @@
 # cryptography functions used by ACE
 #
 
-import io
 import logging
 import os.path
 import random
@@ -18,6 +17,10 @@ import saq
 
 CHUNK_SIZE = 64 * 1024
 
+# the original (pre-padding) size is stored as a little endian 64 bit unsigned int
+# pre-compiled so the per-chunk calls don't re-parse the format string
+_UINT64 = struct.Struct('<Q')
+
 def _get_validation_hash_path():
     """Returns the full path to the file containing the encryption password validation hash."""
     return os.path.join(saq.SAQ_HOME, 'etc', 'validation_hash')
@@ -102,7 +105,7 @@ def encrypt(source_path, target_path, password=None):
 
     with open(source_path, 'rb') as fp_in:
         with open(target_path, 'wb') as fp_out:
-            fp_out.write(struct.pack('<Q', file_size))
+            fp_out.write(_UINT64.pack(file_size))
             fp_out.write(iv)
 
             while True:
@@ -133,8 +136,8 @@ def encrypt_chunk(chunk, password=None):
     if len(chunk) % 16 != 0:
         chunk += b' ' * (16 - len(chunk) % 16)
 
-    result = struct.pack('<Q', original_size) + iv + encryptor.encrypt(chunk)
-    return result
+    # join once rather than building two intermediate concatenations
+    return b''.join([_UINT64.pack(original_size), iv, encryptor.encrypt(chunk)])
 
 def decrypt(source_path, target_path=None, password=None):
     """Decrypts the given file at source_path with the given password and saves the results in target_path.
@@ -149,7 +152,7 @@ def decrypt(source_path, target_path=None, password=None):
     assert len(password) == 32
 
     with open(source_path, 'rb') as fp_in:
-        original_size = struct.unpack('<Q', fp_in.read(struct.calcsize('Q')))[0]
+        original_size = _UINT64.unpack(fp_in.read(_UINT64.size))[0]
         iv = fp_in.read(16)
         decryptor = AES.new(password, AES.MODE_CBC, iv)
 
@@ -175,14 +178,15 @@ def decrypt_chunk(chunk, password=None):
     assert len(password) == 32
 
 
-    _buffer = io.BytesIO(chunk)
-    original_size = struct.unpack('<Q', _buffer.read(struct.calcsize('Q')))[0]
-    iv = _buffer.read(16)
-    chunk = _buffer.read()
+    # parse the header in place rather than copying the chunk through a BytesIO
+    original_size = _UINT64.unpack_from(chunk)[0]
+    iv = chunk[_UINT64.size:_UINT64.size + 16]
+    chunk = chunk[_UINT64.size + 16:]
 
-    #original_size = struct.unpack('<Q', chunk[0:struct.calcsize('Q')])[0]
-    #iv = chunk[struct.calcsize('Q'):struct.calcsize('Q') + 16]
-    #chunk = chunk[struct.calcsize('Q') + 16:]
     decryptor = AES.new(password, AES.MODE_CBC, iv)
     result = decryptor.decrypt(chunk)
+    # avoid another full copy when the chunk wasn't padded
+    if len(result) == original_size:
+        return result
+
     return result[:original_size]
@@ -12,6 +12,9 @@ import uuid
 
 from subprocess import Popen, PIPE, DEVNULL
 
+# how much we read from the tar process at a time when streaming to the remote host
+BLOCK_SIZE = io.DEFAULT_BUFFER_SIZE
+
 def submit_alerts(remote_host, remote_port, ssl_cert, ssl_hostname, ssl_key, ca_path, dirs):
     """Submits the given alerts to the given ACE system. """
     """Returns the list of alerts that were successfully submitted."""
@@ -79,7 +82,7 @@ def submit_alerts(remote_host, remote_port, ssl_cert, ssl_hostname, ssl_key, ca_
         p = Popen(tar_command, stdout=PIPE, stderr=DEVNULL) # XXX catch error output
         total_bytes = 0
         while True:
-            data = p.stdout.read(io.DEFAULT_BUFFER_SIZE)
+            data = p.stdout.read(BLOCK_SIZE)
             if data == b'':
                 break
 
@@ -105,8 +108,12 @@ def submit_alerts(remote_host, remote_port, ssl_cert, ssl_hostname, ssl_key, ca_
         if client_socket:
             try:
                 client_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass # peer already disconnected
+
+            try:
                 client_socket.close()
-            except:
+            except OSError:
                 pass
 
         try:
@@ -11,10 +11,12 @@ import logging
 import multiprocessing
 import os
 import re
+import selectors
 import socket
 import sys
 import threading
 import time
+import weakref
 
 from math import floor
 from threading import Thread, Semaphore, RLock
@@ -24,6 +26,16 @@ from saq.constants import *
 from saq.error import report_exception
 from saq.performance import record_metric
 
+# the fixed protocol commands are ASCII literals sent over and over again
+# so we encode them once here rather than paying str.encode on every send
+COMMAND_WAIT = b'wait|'
+COMMAND_LOCKED = b'locked|'
+COMMAND_OK = b'ok|'
+COMMAND_RELEASE = b'release|'
+
+# the only variable-format command, compiled once instead of per message
+RE_ACQUIRE = re.compile(r'^acquire:([^|]+)\|$')
+
 # this is a fall back device to be used if the network semaphore is unavailable
 fallback_semaphores = {}
 
@@ -100,6 +112,9 @@ class NetworkSemaphoreClient(object):
             logging.debug("attempting connection to {0} port {1}".format(self.config['remote_address'], self.config.getint('remote_port')))
 
             self.socket.connect((self.config['remote_address'], self.config.getint('remote_port')))
+            # the protocol is a sequence of very small request/response messages
+            # disable Nagle so they don't sit in the kernel waiting to be combined
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             logging.debug("requesting semaphore {0}".format(semaphore_name))
 
             # request the semaphore
@@ -125,7 +140,7 @@ class NetworkSemaphoreClient(object):
                     self.start_failsafe_monitor()
                     return True
 
-                elif all([x == 'wait' for x in commands]):
+                elif all(x == 'wait' for x in commands):
                     continue
 
                 else:
@@ -140,7 +155,7 @@ class NetworkSemaphoreClient(object):
             try:
                 if self.socket is not None:
                     self.socket.close()
-            except Exception as e:
+            except OSError:
                 pass
 
             # use the fallback semaphore
@@ -178,7 +193,7 @@ class NetworkSemaphoreClient(object):
 
                 # if we are still in network mode then send a keep-alive message to the server
                 if self.fallback_semaphore is None:
-                    self.socket.sendall('wait|'.encode('ascii'))
+                    self.socket.sendall(COMMAND_WAIT)
 
                 time.sleep(3)
 
@@ -219,7 +234,7 @@ class NetworkSemaphoreClient(object):
         try:
             # send the command for release
             logging.debug("releasing semaphore {0}".format(self.semaphore_name))
-            self.socket.sendall("release|".encode('ascii'))
+            self.socket.sendall(COMMAND_RELEASE)
 
             # wait for the ok
             command = self.socket.recv(128).decode('ascii')
@@ -240,7 +255,7 @@ class NetworkSemaphoreClient(object):
         finally:
             try:
                 self.socket.close()
-            except Exception:
+            except OSError:
                 pass
 
             # make sure we set this so that the monitor thread exits
@@ -257,6 +272,14 @@ class NetworkSemaphoreServer(object):
         # the main listening socket
         self.server_socket = None
 
+        # write side of the socket pair used to wake the accept loop up on shutdown
+        self.shutdown_trigger = None
+
+        # the client handler threads currently running
+        # weak references so finished threads are reaped automatically
+        # rather than requiring O(n) removal from a shared list
+        self.client_threads = weakref.WeakSet()
+
         # configuration settings
         if 'network_semaphore' not in saq.CONFIG:
             logging.error("missing configuration network_semaphore")
@@ -310,20 +333,19 @@ class NetworkSemaphoreServer(object):
         self.shutdown = True
 
         try:
-            logging.debug("closing network socket...")
-            # force the accept() call to break
-            try:
-                s = socket.socket()
-                s.connect((self.config['bind_address'], self.config.getint('bind_port')))
-                s.close()
-            except:
-                pass # doesn't matter...
+            # wake the accept loop up so it notices the shutdown flag
+            if self.shutdown_trigger is not None:
+                self.shutdown_trigger.send(b'\x00')
         except Exception as e:
-            logging.error("unable to close network socket: {0}".format(str(e)))
+            logging.error("unable to signal server shutdown: {0}".format(str(e)))
 
         logging.info("waiting for main thread to exit...")
         self.server_thread.join()
 
+        active_clients = len([t for t in self.client_threads if t.is_alive()])
+        if active_clients:
+            logging.info("{0} client connections still active at shutdown".format(active_clients))
+
         sys.exit(0)
 
     def monitor_loop(self):
@@ -343,36 +365,60 @@ class NetworkSemaphoreServer(object):
                 self.server_socket.bind((self.bind_address, self.bind_port))
                 self.server_socket.listen(5)
 
-                while not self.shutdown:
-                    logging.debug("waiting for next connection on {}:{}".format(self.bind_address, self.bind_port))
-                    client_socket, remote_address = self.server_socket.accept()
-                    remote_host, remote_port = remote_address
-                    logging.info("got connection from {0}:{1}".format(remote_host, remote_port))
-                    if self.shutdown:
-                        return
-
-                    allowed = False
-                    remote_host_ipv4 = ipaddress.ip_address(remote_host)
-                    for ipv4_network in self.allowed_ipv4:
-                        if remote_host_ipv4 in ipv4_network:
-                            allowed = True
-                            break
+                # we block in a selector rather than directly in accept() so the loop
+                # can also watch for other readiness events (such as shutdown)
+                # the client handlers stay on threads because they block waiting on
+                # semaphore acquisition, not on the network
+                selector = selectors.DefaultSelector()
+                selector.register(self.server_socket, selectors.EVENT_READ)
 
-                    if not allowed:
-                        logging.warning("blocking invalid remote host {0}".format(remote_host))
-                        try:
-                            client_socket.close()
-                        except:
-                            pass
+                # stop() writes a byte to this socket pair to wake the selector
+                # immediately rather than relying on network activity
+                wakeup_socket, self.shutdown_trigger = socket.socketpair()
+                selector.register(wakeup_socket, selectors.EVENT_READ)
 
-                        continue
+                try:
+                    while not self.shutdown:
+                        logging.debug("waiting for next connection on {}:{}".format(self.bind_address, self.bind_port))
+                        selector.select()
+                        if self.shutdown:
+                            return
+
+                        client_socket, remote_address = self.server_socket.accept()
+                        remote_host, remote_port = remote_address
+                        logging.info("got connection from {0}:{1}".format(remote_host, remote_port))
+
+                        # see the note in NetworkSemaphoreClient.acquire
+                        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+                        allowed = False
+                        remote_host_ipv4 = ipaddress.ip_address(remote_host)
+                        for ipv4_network in self.allowed_ipv4:
+                            if remote_host_ipv4 in ipv4_network:
+                                allowed = True
+                                break
+
+                        if not allowed:
+                            logging.warning("blocking invalid remote host {0}".format(remote_host))
+                            try:
+                                client_socket.close()
+                            except OSError:
+                                pass
+
+                            continue
+
+                        # start a thread to deal with this client
+                        t = Thread(target=self.client_loop, args=(remote_host, remote_port, client_socket), name="Client {0}".format(remote_host))
+                        t.daemon = True
+                        self.client_threads.add(t)
+                        t.start()
+                        #record_metric(METRIC_THREAD_COUNT, threading.active_count())
+                finally:
+                    selector.close()
+                    wakeup_socket.close()
+                    self.shutdown_trigger.close()
+                    self.shutdown_trigger = None
 
-                    # start a thread to deal with this client
-                    t = Thread(target=self.client_loop, args=(remote_host, remote_port, client_socket), name="Client {0}".format(remote_host))
-                    t.daemon = True
-                    t.start()
-                    #record_metric(METRIC_THREAD_COUNT, threading.active_count())
-                    
             except Exception as e:
                 logging.error("uncaught exception: {0}".format(str(e)))
                 report_exception()
@@ -403,7 +449,7 @@ class NetworkSemaphoreServer(object):
             # SERVER SEND -> ok|
             # any invalid input or errors causes the connection to terminate
 
-            m = re.match(r'^acquire:([^|]+)\|$', command)
+            m = RE_ACQUIRE.match(command)
             if m is None:
                 logging.error("invalid command \"{0}\" from {1}".format(command, remote_connection))
                 return
@@ -424,11 +470,11 @@ class NetworkSemaphoreServer(object):
                         logging.warning("{0} waiting for semaphore {1} cumulative waiting time {2}".format(
                             remote_connection, semaphore_name, datetime.datetime.now() - request_time))
                         # send a heartbeat message back to the client
-                        client_socket.sendall("wait|".encode('ascii'))
+                        client_socket.sendall(COMMAND_WAIT)
                         continue
 
                     logging.info("acquired semaphore {0}".format(semaphore_name))
-                    client_socket.sendall("locked|".encode('ascii'))
+                    client_socket.sendall(COMMAND_LOCKED)
                     break
 
                 # now wait for either the client to release the semaphore
@@ -454,10 +500,10 @@ class NetworkSemaphoreServer(object):
                     commands = command.split('|')
                     if 'release' in commands:
                         # send the OK to the client
-                        client_socket.sendall('ok|'.encode('ascii'))
+                        client_socket.sendall(COMMAND_OK)
                         break
 
-                    if all([x == 'wait' for x in commands]):
+                    if all(x == 'wait' for x in commands):
                         logging.debug("got wait command(s)...")
                         continue
 
@@ -473,7 +519,14 @@ class NetworkSemaphoreServer(object):
         except Exception as e:
             logging.error("uncaught exception for {0}: {1}".format(remote_connection, str(e)))
         finally:
+            # send the FIN now and return the fd promptly rather than
+            # leaving both to garbage collection
+            try:
+                client_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass # peer already disconnected
+
             try:
                 client_socket.close()
-            except:
+            except OSError:
                 pass
@@ -26,7 +26,6 @@ import os
 import pickle
 import signal
 import socket
-import struct
 import subprocess
 import sys
 import tempfile
@@ -77,6 +76,9 @@ class RemoteConnection(object):
         # communcation socket to client
         self.sock = sock
 
+        # buffered read side of the socket (see BufferedSocketReader)
+        self.reader = BufferedSocketReader(sock)
+
         # reference to the Process object
         self.p = None
 
@@ -91,7 +93,7 @@ class RemoteConnection(object):
         self.stderr_reader_thread = None
 
     def handle_request_execute(self):
-        args, kwargs = pickle.loads(read_data_block(self.sock))
+        args, kwargs = pickle.loads(read_data_block(self.reader))
         logging.debug("got job args({}) kwargs({})".format(args, kwargs))
 
         # we always want to be able to kill the entire process tree it creates
@@ -109,7 +111,7 @@ class RemoteConnection(object):
 
         # are we feeding stdin?
         if self.stdin_is_pipe:
-            for data in iterate_data_blocks(self.sock):
+            for data in iterate_data_blocks(self.reader):
                 if self.pipe_mode == MODE_TEXT:
                     data = data.decode()
 
@@ -136,7 +138,7 @@ class RemoteConnection(object):
                 logging.error("unable to close process stdin: {}".format(e))
 
         # read parameters for communicate (or wait)
-        c_args, c_kwargs = pickle.loads(read_data_block(self.sock))
+        c_args, c_kwargs = pickle.loads(read_data_block(self.reader))
 
         logging.debug("waiting for args {} kwargs {} to complete".format(args, kwargs))
         timeout_exception = None
@@ -274,21 +276,29 @@ class RemoteConnection(object):
         # at this point stderr is already sent so send stderr next
         if self.stderr_is_pipe:
             logging.debug("sending {} data blocks for stderr".format(len(self.stderr_buffer)))
+            # the in-memory blocks are bounded by STDERR_BYTE_LIMIT so rather than
+            # paying one send() per block we frame them all up and hand the whole
+            # thing to the kernel in a single sendall
+            frames = []
             for _buffer in self.stderr_buffer:
-                send_data_block(self.sock, _buffer)
+                frames.append(len(_buffer).to_bytes(4, 'big'))
+                frames.append(_buffer)
+
+            if frames:
+                self.sock.sendall(b''.join(frames))
 
             self.stderr_buffer = [] # for gc
 
             # did we write any of stderr to file?
             if self.stderr_fp:
-                # go back to the start of it and send it in chunks
+                # the overflow data is sitting in a regular file so we can send it
+                # as a single data block and let sendfile() move the bytes in-kernel
+                # rather than copying them through python BLOCK_SIZE at a time
+                self.stderr_fp.flush()
+                file_size = os.fstat(self.stderr_fp.fileno()).st_size
                 self.stderr_fp.seek(0)
-                while True:
-                    data = self.stderr_fp.read(BLOCK_SIZE)
-                    if len(data) == 0:
-                        break
-
-                    send_data_block(self.sock, data)
+                self.sock.sendall(file_size.to_bytes(4, 'big'))
+                self.sock.sendfile(self.stderr_fp)
 
             # finish stderr
             send_block0(self.sock)
@@ -369,54 +379,166 @@ def Popen(*args, **kwargs):
 # protocol routines
 #
 
+class BufferedSocketReader(object):
+    """Wraps a socket with a read buffer so that many small framed reads are
+       satisfied out of a single large recv instead of paying a syscall each.
+       Exposes the recv and recv_into calls the protocol routines use, so it
+       drops in anywhere a socket is read from.  Writes still go to the raw socket."""
+
+    def __init__(self, s):
+        self.s = s
+        self._buffer = bytearray(BLOCK_SIZE)
+        self._view = memoryview(self._buffer)
+        self._pos = 0
+        self._end = 0
+
+        # reusable destination buffer handed out by get_scratch
+        # grows on demand and is never shrunk
+        self._scratch = bytearray(4096)
+
+    def get_scratch(self, n):
+        """Returns a memoryview of exactly n bytes backed by a reusable buffer.
+           Each call invalidates the view returned by the previous call."""
+        if len(self._scratch) < n:
+            self._scratch = bytearray(n)
+
+        return memoryview(self._scratch)[:n]
+
+    def _fill(self):
+        """Refills the buffer with a single large recv.  Returns the number of bytes read."""
+        self._pos = 0
+        self._end = self.s.recv_into(self._buffer, BLOCK_SIZE)
+        return self._end
+
+    def recv(self, n):
+        if self._pos == self._end:
+            if self._fill() == 0:
+                return b''
+
+        end = self._pos + n
+        if end > self._end:
+            end = self._end
+
+        result = bytes(self._view[self._pos:end])
+        self._pos = end
+        return result
+
+    def recv_into(self, view, n=None):
+        if n is None or n > len(view):
+            n = len(view)
+
+        if self._pos == self._end:
+            # a read this large would just drain the buffer again
+            # so skip the extra copy and go straight to the socket
+            if n >= BLOCK_SIZE:
+                return self.s.recv_into(view, n)
+
+            if self._fill() == 0:
+                return 0
+
+        count = self._end - self._pos
+        if count > n:
+            count = n
+
+        view[:count] = self._view[self._pos:self._pos + count]
+        self._pos += count
+        return count
+
 def read_n_bytes(s, n):
-    """Reads n bytes from socket s.  Returns the bytearray of the data read."""
+    """Reads n bytes from socket s.  Returns the bytes of the data read."""
+    # receive directly into a pre-allocated buffer so we don't allocate
+    # (and then join) a throwaway bytes object for every recv
+    # a BufferedSocketReader provides a reusable buffer so the common small
+    # reads don't allocate a destination at all
+    get_scratch = getattr(s, 'get_scratch', None)
+    if get_scratch is not None:
+        view = get_scratch(n)
+    else:
+        view = memoryview(bytearray(n))
+
+    recv_into = s.recv_into # bound once -- this loop runs per recv
     bytes_read = 0
-    _buffer = []
     while bytes_read < n:
-        data = s.recv(n - bytes_read)
-        if data == b'':
+        count = recv_into(view[bytes_read:], n - bytes_read)
+        if count == 0:
             break
 
-        bytes_read += len(data)
-        _buffer.append(data)
+        bytes_read += count
 
-    result = b''.join(_buffer)
-    if len(result) != n:
-        logging.warning("expected {} bytes but read {}".format(n, len(result)))
+    if bytes_read != n:
+        logging.warning("expected {} bytes but read {}".format(n, bytes_read))
+        return bytes(view[:bytes_read])
 
-    return b''.join(_buffer)
+    return bytes(view)
 
 def read_data_block_size(s):
     """Reads the size of the next data block from the given socket."""
-    size = struct.unpack('!I', read_n_bytes(s, 4))
-    size = size[0]
-    logging.debug("read command block size {}".format(size))
-    return size
+    # this runs once per data block so skip the buffer machinery of read_n_bytes
+    # the 4 byte length almost always arrives in a single recv
+    header = s.recv(4)
+    while 0 < len(header) < 4:
+        data = s.recv(4 - len(header))
+        if data == b'':
+            break
+
+        header += data
+
+    if len(header) != 4:
+        logging.warning("expected 4 bytes but read {}".format(len(header)))
+
+    return int.from_bytes(header, 'big')
 
 def read_data_block(s):
-    """Reads the next data block from socket s. Returns the bytearray of the data portion of the block."""
+    """Reads the next data block from socket s. Returns the bytes of the data portion of the block."""
     # read the size of the data block (4 byte network order integer)
-    size = struct.unpack('!I', read_n_bytes(s, 4))
-    size = size[0]
-    #logging.debug("read command block size {}".format(size))
-    # read the data portion of the data block
-    return read_n_bytes(s, size)
+    # then read the data portion of the data block
+    return read_n_bytes(s, read_data_block_size(s))
 
 def iterate_data_blocks(s):
     """Reads the next data block until a block0 is read."""
     while True:
         block = read_data_block(s)
         if len(block) == 0:
-            raise StopIteration()
+            return # raising StopIteration inside a generator is a RuntimeError as of 3.7 (PEP 479)
     
         yield block
 
+def read_data_blocks_into(s, fp):
+    """Reads data blocks from socket s directly into file object fp until the
+       zero-length terminating block is read.  Returns the total number of bytes written.
+       Unlike iterate_data_blocks this reuses a single scratch buffer rather than
+       allocating a new buffer for every block."""
+    scratch = bytearray(BLOCK_SIZE)
+    view = memoryview(scratch)
+    recv_into = s.recv_into # bound once -- these loops run per block and per recv
+    write = fp.write
+    total_bytes = 0
+    while True:
+        size = read_data_block_size(s)
+        if size == 0:
+            return total_bytes
+
+        bytes_left = size
+        while bytes_left > 0:
+            count = recv_into(view, BLOCK_SIZE if BLOCK_SIZE < bytes_left else bytes_left)
+            if count == 0:
+                logging.warning("expected {} more bytes in data block".format(bytes_left))
+                return total_bytes
+
+            write(view[:count])
+            total_bytes += count
+            bytes_left -= count
+
 def send_data_block(s, data):
     """Writes the given data to the given socket as a data block."""
-    message = b''.join([struct.pack("!I", len(data)), data])
-    #logging.debug("sending data block length {} ({})".format(len(message), message[:64]))
-    s.sendall(message)
+    # scatter-gather send: the kernel picks up the header and the payload in one
+    # syscall without us copying them into a combined buffer first
+    header = len(data).to_bytes(4, 'big')
+    #logging.debug("sending data block length {} ({})".format(len(data), data[:64]))
+    sent = s.sendmsg([header, data])
+    if sent < 4 + len(data):
+        # unlike sendall, sendmsg does not retry partial sends
+        s.sendall((header + data)[sent:])
 
 def send_block0(s):
     """Writes an empty data block to the given socket."""
@@ -445,6 +567,8 @@ class SubprocessServerJob(object):
 
         # connection to the process server (unix socket)
         self.connection = None
+        # buffered read side of the connection
+        self.connection_reader = None
 
         # command arguments
         self.command_args = args
@@ -508,6 +632,7 @@ class SubprocessServerJob(object):
             logging.debug("connecting to {}".format(socket_path))
             self.connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
             self.connection.connect(socket_path)
+            self.connection_reader = BufferedSocketReader(self.connection)
 
             # make a copy because we're going to modify it before we send it
             kwargs = self.command_kwargs.copy()
@@ -648,16 +773,21 @@ class SubprocessServerJob(object):
 
                 _buffer = []
                 logging.debug("reading stdout stream")
-                for data in iterate_data_blocks(self.connection):
-                    # are we in text mode?
-                    if self.pipe_mode == MODE_TEXT:
-                        data = data.decode()
+                if self._stdout_fd and self.pipe_mode == MODE_BINARY:
+                    # in binary mode we can stream the blocks straight into the
+                    # target file without allocating a buffer for each block
+                    read_data_blocks_into(self.connection_reader, self._stdout_fd)
+                else:
+                    for data in iterate_data_blocks(self.connection_reader):
+                        # are we in text mode?
+                        if self.pipe_mode == MODE_TEXT:
+                            data = data.decode()
 
-                    # are we writing these to a file?
-                    if self._stdout_fd:
-                        self._stdout_fd.write(data)
-                    else:
-                        _buffer.append(data)
+                        # are we writing these to a file?
+                        if self._stdout_fd:
+                            self._stdout_fd.write(data)
+                        else:
+                            _buffer.append(data)
 
                 logging.debug("finished reading stdout stream")
 
@@ -684,16 +814,20 @@ class SubprocessServerJob(object):
 
                 _buffer = []
                 logging.debug("reading stderr stream")
-                for data in iterate_data_blocks(self.connection):
-                    # are we in text mode?
-                    if self.pipe_mode == MODE_TEXT:
-                        data = data.decode()
+                if self._stderr_fd and self.pipe_mode == MODE_BINARY:
+                    # see the stdout note above
+                    read_data_blocks_into(self.connection_reader, self._stderr_fd)
+                else:
+                    for data in iterate_data_blocks(self.connection_reader):
+                        # are we in text mode?
+                        if self.pipe_mode == MODE_TEXT:
+                            data = data.decode()
 
-                    # are we writing these to a file?
-                    if self._stderr_fd:
-                        self._stderr_fd.write(data)
-                    else:
-                        _buffer.append(data)
+                        # are we writing these to a file?
+                        if self._stderr_fd:
+                            self._stderr_fd.write(data)
+                        else:
+                            _buffer.append(data)
 
                 logging.debug("finished reading stderr stream")
 
@@ -716,7 +850,7 @@ class SubprocessServerJob(object):
             
             # get the last data block
             logging.debug("reading last data block")
-            (self._returncode, self.exception ) = pickle.loads(read_data_block(self.connection))
+            (self._returncode, self.exception ) = pickle.loads(read_data_block(self.connection_reader))
             self.results_available = True
             logging.debug("finished data transfer")
 